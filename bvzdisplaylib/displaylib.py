@@ -4,8 +4,10 @@ A library to display things on screen.
 
 from __future__ import print_function
 
-import math
+import functools
+import re
 import sys
+import time
 
 # define some colors
 # ----------------------------------------------------------------------------------------------------------------------
@@ -29,6 +31,326 @@ BG_RED = "\u001b[41m"
 BLINK = "\033[5m"
 
 
+# ----------------------------------------------------------------------------------------------------------------------
+class _ColorMap(dict):
+    """
+    A dictionary of color tags to color codes. Unknown tags are returned unchanged (in their {TAG} form) instead of
+    raising a KeyError, so that they pass through format_string untouched.
+    """
+
+    def __missing__(self, key):
+        return "{" + key + "}"
+
+
+# map of the color tags that may be embedded in strings passed to format_string
+_COLORS = _ColorMap({
+    "BLACK": BLACK,
+    "RED": RED,
+    "GREEN": GREEN,
+    "YELLOW": YELLOW,
+    "BLUE": BLUE,
+    "MAGENTA": MAGENTA,
+    "CYAN": CYAN,
+    "WHITE": WHITE,
+    "BRIGHT_RED": BRIGHT_RED,
+    "BRIGHT_GREEN": BRIGHT_GREEN,
+    "BRIGHT_YELLOW": BRIGHT_YELLOW,
+    "BRIGHT_BLUE": BRIGHT_BLUE,
+    "BRIGHT_MAGENTA": BRIGHT_MAGENTA,
+    "BRIGHT_CYAN": BRIGHT_CYAN,
+    "BRIGHT_WHITE": BRIGHT_WHITE,
+    "COLOR_NONE": ENDC,
+    "BG_RED": BG_RED,
+    "BLINK": BLINK,
+})
+
+# everything format_string converts, matched in a single pass: color tags (in either {{COLOR}} or {COLOR} form),
+# literal \n strings, and escaped braces
+_ESCAPE_MAP = {r"\n": "\n", "{{": "{", "}}": "}"}
+_FORMAT_RE = re.compile(r"\{\{?([A-Z_]+)\}\}?|\\n|\{\{|\}\}")
+
+# every possible result of format_boolean, keyed on (colorize, invert_color, value)
+_BOOL_TABLE = {
+    (True, False, True): f"{BRIGHT_GREEN}Yes{ENDC}",
+    (True, False, False): f"{BRIGHT_RED}No{ENDC}",
+    (True, True, True): f"{BRIGHT_RED}Yes{ENDC}",
+    (True, True, False): f"{BRIGHT_GREEN}No{ENDC}",
+    (False, False, True): "Yes",
+    (False, False, False): "No",
+    (False, True, True): "Yes",
+    (False, True, False): "No",
+}
+
+# prefix used when building the "X of Y" portion of the progress bar
+_COUNT_PREFIX = " (" + BRIGHT_WHITE
+
+# when not writing to a terminal, refreshes are left in the stream's buffer and only flushed this often (seconds)
+_FLUSH_INTERVAL = 0.1
+
+# when the stream was last flushed by _flush_refresh
+_last_flush = time.monotonic()
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def _is_tty(stream):
+    """
+    Returns whether the given stream is an interactive terminal. Only interactive terminals need to be flushed after each
+    refresh. This is checked on every call (instead of once at import) so that streams swapped in later (for example by
+    contextlib.redirect_stdout) are honored, and streams that only provide write and flush are treated as non-terminals.
+
+    :param stream:
+           The stream to check.
+
+    :return: True if the stream is a terminal, False otherwise.
+    """
+
+    isatty = getattr(stream, "isatty", None)
+    if isatty is None:
+        return False
+    try:
+        return isatty()
+    except (ValueError, OSError):
+        return False
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def _flush_refresh(stream):
+    """
+    Flushes the stream after a refresh (a progress bar update or a refreshable message). Terminals are flushed every
+    time. Other streams are left to coalesce the refreshes in their own buffer, but are still flushed every
+    _FLUSH_INTERVAL seconds so that a log being followed sees regular progress.
+
+    :param stream:
+           The stream that was just written to.
+
+    :return: Nothing.
+    """
+
+    global _last_flush
+
+    if _is_tty(stream):
+        stream.flush()
+        return
+
+    now = time.monotonic()
+    if now - _last_flush > _FLUSH_INTERVAL:
+        stream.flush()
+        _last_flush = now
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+@functools.lru_cache(maxsize=8)
+def _build_bar_template(width,
+                        completed_char,
+                        empty_char):
+    """
+    Builds every possible state of a progress bar of the given width. These only depend on the width and characters
+    used, so they are built once and re-used for every subsequent update.
+
+    :param width:
+           How wide the progress bar is in characters.
+    :param completed_char:
+           The character to display for a completed chunk.
+    :param empty_char:
+           The character to display for an as-yet uncompleted chunk.
+
+    :return: A tuple of width + 1 strings, where the item at index k is the bracketed bar with k completed chunks.
+    """
+
+    return tuple("[" + completed_char * k + empty_char * (width - k) + "]" for k in range(width + 1))
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def _render_bar(width,
+                completed_char,
+                empty_char,
+                tick):
+    """
+    Renders the part of the progress bar that only depends on the percentage: the bar itself with the percent inserted
+    into it, followed by the start of the count string.
+
+    :param width:
+           How wide the progress bar is in characters.
+    :param completed_char:
+           The character to display for a completed chunk.
+    :param empty_char:
+           The character to display for an as-yet uncompleted chunk.
+    :param tick:
+           The percent in tenths of a percent.
+
+    :return: The rendered string.
+    """
+
+    # look up the completed and uncompleted portions of the progress bar (out of range counts show a full or empty bar)
+    bar = _build_bar_template(width, completed_char, empty_char)[max(0, min((tick * width + 500) // 1000, width))]
+
+    # split the bar around the (eight character) percent string
+    center = (width + 2) // 2
+    return f"{bar[:center - 2]}{BRIGHT_YELLOW}{tick / 10:6.1f}% {ENDC}{bar[center + 6:]}{_COUNT_PREFIX}"
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+@functools.lru_cache(maxsize=8)
+def _build_tick_template(width,
+                         completed_char,
+                         empty_char):
+    """
+    Renders the progress bar for every tick from 0% to 100% (in tenths of a percent). Like _build_bar_template, these
+    only depend on the width and characters used, so an update only needs to index into the result.
+
+    :param width:
+           How wide the progress bar is in characters.
+    :param completed_char:
+           The character to display for a completed chunk.
+    :param empty_char:
+           The character to display for an as-yet uncompleted chunk.
+
+    :return: A tuple of 1001 strings, where the item at index tick is the output of _render_bar for that tick.
+    """
+
+    return tuple(_render_bar(width, completed_char, empty_char, tick) for tick in range(1001))
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+class ProgressBar(object):
+    """
+    An ASCII progress bar drawn on stdout. Everything that does not change from one update to the next (the rendered bar
+    for every percentage, the colorized total, etc.) is built once when the progress bar is created, so that each
+    update only has to do a bit of integer math and a table lookup.
+    """
+
+    __slots__ = ("_width", "_completed_char", "_empty_char", "_total", "_double_total", "_bar_lut", "_total_str",
+                 "_last_tick", "_postpend")
+
+    def __init__(self,
+                 total,
+                 width=50,
+                 completed_char="#",
+                 empty_char=".",
+                 postpend_str=""):
+        """
+        :param total:
+               The count at 100%.
+        :param width:
+               How wide to draw the progress bar in characters. If given an odd number, it will be rounded down to the
+               nearest even value.
+        :param completed_char:
+               The character to display for a completed chunk.
+        :param empty_char:
+               The character to display for an as-yet uncompleted chunk.
+        :param postpend_str:
+               An arbitrary (and optional) string to append to the end of the progress bar.
+        """
+
+        # only allow even numbered widths
+        if width % 2 != 0:
+            width -= 1
+
+        self._width = width
+        self._completed_char = completed_char
+        self._empty_char = empty_char
+        self._total = total
+        self._double_total = 2 * total
+        self._bar_lut = _build_tick_template(width, completed_char, empty_char)
+
+        self._total_str = f"{ENDC} of {BRIGHT_WHITE}{total}{ENDC})"
+        self._last_tick = None
+        self._postpend = postpend_str
+
+    @property
+    def last_tick(self):
+        """
+        :return: The value returned by the last update (None if there has not been one yet).
+        """
+
+        return self._last_tick
+
+    @last_tick.setter
+    def last_tick(self,
+                  tick):
+        """
+        Sets the tick that the next update is compared against. Used when the caller (rather than this object) keeps
+        track of the previous state, for example when a progress bar is shared between several callers.
+
+        :param tick:
+               The value returned by a previous update, or None to force the next update to redraw.
+
+        :return: Nothing.
+        """
+
+        self._last_tick = tick
+
+    def update(self,
+               count,
+               postpend_str=None):
+        """
+        Redraws the progress bar if the percentage has changed since the last update.
+
+        :param count:
+               The current count for our progress bar.
+        :param postpend_str:
+               An optional string to append to the end of the progress bar. If None, the string given when the progress
+               bar was created is used. Defaults to None.
+
+        :return: An opaque integer (the percent in tenths of a percent) for the current state.
+        """
+
+        # calculate the percent in tenths of a percent (rounded half up). Coerced to int since float counts and totals
+        # are allowed.
+        tick = int((count * 2000 + self._total) // self._double_total)
+
+        # only update the display if the percentage has changed
+        if tick == self._last_tick and count != 0:
+            return tick
+        self._last_tick = tick
+
+        # look up the pre-rendered bar and percent (counts outside of 0 to total are rare, so render those on demand)
+        if 0 <= tick <= 1000:
+            bar_str = self._bar_lut[tick]
+        else:
+            bar_str = _render_bar(self._width, self._completed_char, self._empty_char, tick)
+
+        # append the X out of Y text and the postpend string
+        progress_bar_str = "".join((bar_str,
+                                    str(count),
+                                    self._total_str,
+                                    self._postpend if postpend_str is None else postpend_str))
+
+        # show it and return to start of line
+        stdout = sys.stdout
+        stdout.write(progress_bar_str + "\r")
+        _flush_refresh(stdout)
+
+        # return the tick (so that we only update the percentage when it changes)
+        return tick
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+@functools.lru_cache(maxsize=32, typed=True)
+def _get_progress_bar(total,
+                      width,
+                      completed_char,
+                      empty_char):
+    """
+    Returns a shared ProgressBar for the given settings, so that display_progress does not have to rebuild one on every
+    call. The cache is typed so that, for example, totals of 100 and 100.0 get their own progress bars (and therefore
+    display their own total).
+
+    :param total:
+           The count at 100%.
+    :param width:
+           How wide to draw the progress bar in characters.
+    :param completed_char:
+           The character to display for a completed chunk.
+    :param empty_char:
+           The character to display for an as-yet uncompleted chunk.
+
+    :return: A ProgressBar object.
+    """
+
+    return ProgressBar(total, width, completed_char, empty_char)
+
+
 # ----------------------------------------------------------------------------------------------------------------------
 def display_progress(count,
                      total,
@@ -38,14 +360,16 @@ def display_progress(count,
                      empty_char=".",
                      postpend_str=""):
     """
-    Draws and updates ASCII progress bar on the stdout.
+    Draws and updates ASCII progress bar on the stdout. This is a convenience wrapper around the ProgressBar class for
+    callers that track the previous state themselves.
 
     :param count:
            The current count for our progress bar.
     :param total:
            The count at 100%.
     :param old_percent:
-           The previous percent. Necessary to prevent updates if the percentage has not changed since the last call.
+           The value returned by the previous call. Necessary to prevent updates if the percentage has not changed since
+           the last call.
     :param width:
            How wide to draw the progress bar in characters. If given an odd number, it will be rounded down to the
            nearest even value.
@@ -56,72 +380,52 @@ def display_progress(count,
     :param postpend_str:
            An arbitrary (and optional) string to append to the end of the progress bar.
 
-    :return: The percent value for the current state.
+    :return: An opaque integer (the percent in tenths of a percent) for the current state. Pass it back in as
+             old_percent on the next call.
     """
 
-    # only allow even numbered widths
-    if width % 2 != 0:
-        width -= 1
-
-    # calculate the percent
-    percent = round((count * 1.0) / total * 100, 1)
-
-    # only update the display if the percentage has changed
-    if percent == old_percent and percent != 0:
-        return percent
-
-    # build the completed and uncompleted portions of the progress bar
-    done_str = "{0}".format(completed_char * (int(round(percent / (100 / width), 0))))
-    empty_str = "{0}".format(empty_char * (width - (int(round(percent / (100 / width))))))
+    # the progress bar is shared by every caller with the same settings, so its state always comes from the caller
+    progress_bar = _get_progress_bar(total, width, completed_char, empty_char)
+    progress_bar.last_tick = old_percent
+    return progress_bar.update(count, postpend_str)
 
-    # build the X out of Y text
-    count_str = " (" + BRIGHT_WHITE + str(count) + ENDC + " of " + BRIGHT_WHITE + str(total) + ENDC + ")"
 
-    # build the percent string
-    percent_str = "{0}".format(" " * (4 - len(str(int(math.floor(percent)))))) + str(percent) + "%" + " "
-
-    # build the complete string, and insert the percent
-    progress_bar_str = "[" + done_str + empty_str + "]"
-    progress_left = progress_bar_str[:int((len(progress_bar_str) / 2) - math.floor(len(percent_str) / 2)) + 2]
-    progress_right = progress_bar_str[int((len(progress_bar_str) / 2) + math.ceil(len(percent_str) / 2)) + 2:]
-    progress_bar_str = progress_left
-    progress_bar_str += BRIGHT_YELLOW + percent_str + ENDC
-    progress_bar_str += progress_right
-
-    # append the count string
-    progress_bar_str += count_str
-
-    # append the postpend string
-    progress_bar_str += postpend_str
+# ----------------------------------------------------------------------------------------------------------------------
+def display_error(*msgs):
+    """
+    Given any number of args, converts those args to strings, concatenates them, and prints to stdErr.
 
-    # show it
-    sys.stdout.write(progress_bar_str)
-    sys.stdout.flush()
-    sys.stdout.write("\b" * (len(progress_bar_str)))  # return to start of line
+    :return: Nothing.
+    """
 
-    # return the percent (so that we only update the percentage when it changes)
-    return percent
+    print(*msgs, file=sys.stderr)
 
 
 # ----------------------------------------------------------------------------------------------------------------------
-def display_error(*msgs):
+def _format_token(match):
     """
-    Given any number of args, converts those args to strings, concatenates them, and prints to stdErr.
+    Converts a single token matched by _FORMAT_RE.
 
-    :return: Nothing.
+    :param match:
+           The regex match object.
+
+    :return: The color code for a known color tag, the (un-doubled) tag itself for an unknown tag, or the converted
+             escape sequence.
     """
 
-    output = ""
-    for msg in msgs:
-        output += " " + str(msg)
-    print(output.lstrip(" "), file=sys.stderr)
+    color = match.group(1)
+    if color is not None:
+        return _COLORS[color]
+    return _ESCAPE_MAP[match.group(0)]
 
 
 # ----------------------------------------------------------------------------------------------------------------------
+@functools.lru_cache(maxsize=1024)
 def format_string(msg_str):
     """
     Given a string (msg) this will format it with colors based on the {{COLOR}} tags. (example {{COLOR_RED}}). It will
-    also convert literal \n character string into a proper newline.
+    also convert literal \n character string into a proper newline. Results are cached, so repeatedly formatting the
+    same string is cheap (call format_string.cache_clear() to empty the cache).
 
     :param msg_str:
            The string to format.
@@ -129,39 +433,11 @@ def format_string(msg_str):
     :return: The formatted string.
     """
 
-    output = msg_str.replace(r"\n", "\n")
-    output = output.replace("{{", "{")
-    output = output.replace("}}", "}")
+    # most strings have no tags or escapes at all, in which case there is nothing to substitute
+    if "{" not in msg_str and "}" not in msg_str and "\\" not in msg_str:
+        return msg_str + ENDC
 
-    try:
-        output = output.format(
-            BLACK=BLACK,
-            RED=RED,
-            GREEN=GREEN,
-            YELLOW=YELLOW,
-            BLUE=BLUE,
-            MAGENTA=MAGENTA,
-            CYAN=CYAN,
-            WHITE=WHITE,
-            BRIGHT_RED=BRIGHT_RED,
-            BRIGHT_GREEN=BRIGHT_GREEN,
-            BRIGHT_YELLOW=BRIGHT_YELLOW,
-            BRIGHT_BLUE=BRIGHT_BLUE,
-            BRIGHT_MAGENTA=BRIGHT_MAGENTA,
-            BRIGHT_CYAN=BRIGHT_CYAN,
-            BRIGHT_WHITE=BRIGHT_WHITE,
-            COLOR_NONE=ENDC,
-            BG_RED=BG_RED,
-            BLINK=BLINK,
-        )
-    except KeyError:
-        pass
-    except ValueError:
-        pass
-
-    output += ENDC
-
-    return output
+    return _FORMAT_RE.sub(_format_token, msg_str) + ENDC
 
 
 # ----------------------------------------------------------------------------------------------------------------------
@@ -172,9 +448,11 @@ def msg(*msgs: object):
     :return: Nothing.
     """
 
-    msg = " ".join([str(item) for item in msgs])
-    msg = format_string(msg)
-    print(msg)
+    if len(msgs) == 1:
+        msg = msgs[0] if type(msgs[0]) is str else str(msgs[0])
+    else:
+        msg = " ".join(map(str, msgs))
+    print(format_string(msg))
 
 
 # ----------------------------------------------------------------------------------------------------------------------
@@ -213,35 +491,31 @@ def multiple_choice_user_input(*msgs,
 
     options = [item.upper() for item in legal_answers]
 
-    if alternate_legal_answers is not None:
-        for key, value in alternate_legal_answers.items():
-            assert value.upper() in options
+    alternate_legal_answers_upper = {key.upper(): value for key, value in (alternate_legal_answers or {}).items()}
+    legal_options = frozenset(options)
+    alternate_options = frozenset(alternate_legal_answers_upper)
 
-    if default is not None:
-        assert default.upper() in options
-
-    alternate_options = list()
-    if alternate_legal_answers is not None:
-        alternate_options = [item.upper() for item in alternate_legal_answers.keys()]
+    for value in alternate_legal_answers_upper.values():
+        assert value.upper() in legal_options
 
-    alternate_legal_answers_upper = dict()
-    if alternate_legal_answers is not None:
-        for key in alternate_legal_answers.keys():
-            alternate_legal_answers_upper[key.upper()] = alternate_legal_answers[key]
+    if default is not None:
+        assert default.upper() in legal_options
 
+    # the prompt never changes between attempts, so only format it once
     options_str = f"({','.join(options)})"
+    prompt_msg = format_string(" ".join(map(str, msgs + (options_str,))))
+
+    if default is None:
+        prompt = "> "
+    else:
+        prompt = format_string(f"({{BRIGHT_YELLOW}}{default.upper()}{{COLOR_NONE}}) > ")
 
     if blank_lines > 0:
         msg("\n" * blank_lines)
 
     result = ""
-    while result.upper() not in legal_answers and result.upper() not in alternate_options:
-        msg(*msgs, options_str)
-
-        if default is None:
-            prompt = "> "
-        else:
-            prompt = format_string(f"({{BRIGHT_YELLOW}}{default.upper()}{{COLOR_NONE}}) > ")
+    while (result_upper := result.upper()) not in legal_options and result_upper not in alternate_options:
+        print(prompt_msg)
 
         try:
             result = input(prompt)
@@ -251,10 +525,10 @@ def multiple_choice_user_input(*msgs,
         if result == "" and default is not None:
             result = default.upper()
 
-    if result.upper() in alternate_options:
-        result = alternate_legal_answers_upper[result.upper()]
+    if result_upper in alternate_options:
+        return alternate_legal_answers_upper[result_upper].upper()
 
-    return result.upper()
+    return result_upper
 
 
 # ----------------------------------------------------------------------------------------------------------------------
@@ -278,17 +552,10 @@ def format_boolean(value,
 
     assert type(value) is bool or (type(value) is str and value.upper() in ("TRUE", "FALSE"))
 
-    if str(value).upper() == "TRUE":
-        color = "BRIGHT_GREEN"
-        return_value = "Yes"
-    else:
-        color = "BRIGHT_RED"
-        return_value = "No"
-
-    if colorize:
-        return_value = format_string("{{" + color + "}}" + return_value)
+    if type(value) is str:
+        value = value.upper() == "TRUE"
 
-    return return_value
+    return _BOOL_TABLE[(bool(colorize), bool(invert_color), value)]
 
 
 # ----------------------------------------------------------------------------------------------------------------------
@@ -304,11 +571,14 @@ def display_refreshable_message(*msgs):
     """
 
     # Print the message, flush buffer, and move back to the beginning of the line.
-    message = " ".join([str(item) for item in msgs])
+    if len(msgs) == 1:
+        message = msgs[0] if type(msgs[0]) is str else str(msgs[0])
+    else:
+        message = " ".join(map(str, msgs))
     message = format_string(message)
-    sys.stdout.write(message)
-    sys.stdout.flush()
-    sys.stdout.write("\b" * (len(message)))
+    stdout = sys.stdout
+    stdout.write(message + "\r")
+    _flush_refresh(stdout)
 
 
 # ----------------------------------------------------------------------------------------------------------------------
@@ -317,15 +587,16 @@ def flush_refreshable_message(length=80):
     Call to clear out the current line. Used primarily when a line has been half printed and needs to be removed. This
     does NOT move the cursor to a new line, it just clears out the current line and leaves the cursor at the beginning.
 
-    :param length: How many spaces to flush. Defaults to 80.
+    :param length: How many spaces to flush. No longer used since the whole line is erased, but kept for backwards
+           compatibility. Defaults to 80.
 
     :return: Nothing.
     """
 
-    sys.stdout.write("\b" * length)
-    sys.stdout.write(" " * length)
-    sys.stdout.write("\b" * length)
-    sys.stdout.flush()
+    # return to the start of the line and erase to the end of the line
+    stdout = sys.stdout
+    stdout.write("\r\033[K")
+    _flush_refresh(stdout)
 
 
 # ----------------------------------------------------------------------------------------------------------------------